@@ -1,34 +1,119 @@
 import os
 import sqlite3
+import errno
+import functools
 import hashlib
 import shutil
 import json
+import tempfile
 import time
+import itertools
+import mmap
+import multiprocessing
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from pathlib import Path
 
+try:
+    import blake3
+except ImportError:  # optional: new databases fall back to SHA-256
+    blake3 = None
+
+try:
+    import bkhash  # optional native extension; see native/README.md to build it
+except ImportError:  # hashing stays in Python
+    bkhash = None
+
+try:
+    from fastcdc import fastcdc
+except ImportError:  # optional: files are split into fixed-size chunks instead
+    fastcdc = None
+
+try:
+    import zstandard
+except ImportError:  # optional: new databases store objects uncompressed
+    zstandard = None
+
 DB_FILE = "backup.db"
 SNAPSHOT_DIR = "snapshots"
+SCHEMA_VERSION = 5  # bumped whenever _init_db gains a migration step
+BATCH_SIZE = 10000  # rows per executemany flush during snapshot
+READ_BUFFER_SIZE = 1 << 20  # minimum size of the per-thread hashing buffer
+MMAP_THRESHOLD = 2 << 20  # files at least this large are read through mmap
+CHUNK_MIN_SIZE = 16 << 10
+CHUNK_AVG_SIZE = 64 << 10  # also the fixed chunk size when fastcdc is unavailable
+CHUNK_MAX_SIZE = 256 << 10
+ZSTD_LEVEL = 3
+CHECK_PARALLEL_THRESHOLD = 1000  # below this many stored objects, check() verifies in-process
 
 class BackupTool:
     def __init__(self, db_path=DB_FILE):
         self.db_path = db_path
+        # Each database owns its object store, kept next to it so neither the working directory
+        # nor other databases (whose prune would collect objects they do not reference) can reach it.
+        db_dir, db_name = os.path.split(os.path.abspath(db_path))
+        self.object_dir = os.path.join(db_dir, SNAPSHOT_DIR, db_name, "objects")
+        self._local = threading.local()
+        self._unsynced_objects = 0
+        self._unsynced_lock = threading.Lock()
+        os.makedirs(self.object_dir, exist_ok=True)
+        # One connection serves the whole lifetime of the tool; see _tx for transaction boundaries.
+        self.conn = self._connect()
         self._init_db()
-        
+
+    def close(self):
+        self.conn.close()
+
+    def __getstate__(self):
+        # Thread-local buffers, locks and the connection cannot be pickled; processes that unpickle
+        # the tool get fresh ones and open their own connections.
+        state = self.__dict__.copy()
+        del state["_local"]
+        del state["_unsynced_lock"]
+        del state["conn"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._local = threading.local()
+        self._unsynced_lock = threading.Lock()
+
     def _connect(self):
-        """Helper function to create a connection and enforce foreign keys."""
-        conn = sqlite3.connect(self.db_path)
+        """Helper function to create a connection, enforce foreign keys and apply bulk-ingest tuning."""
+        # Autocommit mode: the driver never opens transactions implicitly, _tx does it explicitly.
+        conn = sqlite3.connect(self.db_path, isolation_level=None)
         conn.execute("PRAGMA foreign_keys = ON;")
+        conn.execute("PRAGMA synchronous = NORMAL;")  # safe under WAL: fsync at checkpoints, not every commit
+        conn.execute("PRAGMA temp_store = MEMORY;")
+        conn.execute("PRAGMA cache_size = -200000;")  # ~200 MB page cache
+        conn.execute("PRAGMA mmap_size = 1073741824;")
         return conn
-    
+
+    @contextmanager
+    def _tx(self, mode="IMMEDIATE"):
+        """Run the block as one explicit transaction on the shared connection, rolling back on error."""
+        self.conn.execute(f"BEGIN {mode}")
+        try:
+            yield self.conn.cursor()
+        except BaseException:
+            if self.conn.in_transaction:
+                self.conn.execute("ROLLBACK")
+            raise
+        self.conn.execute("COMMIT")
+
     def _init_db(self):
-        os.makedirs(SNAPSHOT_DIR, exist_ok=True)
-        with self._connect() as conn:
-            cursor = conn.cursor()
-            cursor.execute("PRAGMA foreign_keys = ON;")  # Enable foreign key constraints
+        # Both pragmas must run outside a transaction.
+        self.conn.execute("PRAGMA auto_vacuum = INCREMENTAL;")  # Only takes effect on a new, empty database
+        self.conn.execute("PRAGMA journal_mode = WAL;")  # Persistent: stored in the database file
+        with self._tx() as cursor:
+            existing = cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'file_data'").fetchone()
+            cursor.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL)")
             cursor.execute("""
                 CREATE TABLE IF NOT EXISTS snapshots (
                     id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    timestamp TEXT NOT NULL
+                    timestamp TEXT NOT NULL,
+                    total_size INTEGER NOT NULL DEFAULT 0
                 )
             """
             )
@@ -36,7 +121,7 @@ class BackupTool:
                 CREATE TABLE IF NOT EXISTS files (
                     snapshot_id INTEGER,
                     path TEXT,
-                    hash TEXT,
+                    hash BLOB,
                     size INTEGER,
                     FOREIGN KEY(snapshot_id) REFERENCES snapshots(id) ON DELETE CASCADE
                 )
@@ -44,92 +129,455 @@ class BackupTool:
             )
             cursor.execute("""
                 CREATE TABLE IF NOT EXISTS file_data (
-                    hash TEXT PRIMARY KEY,
-                    content BLOB,
+                    hash BLOB PRIMARY KEY,
+                    size INTEGER
+                )
+            """
+            )
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS chunk_data (
+                    hash BLOB PRIMARY KEY,
                     size INTEGER
                 )
             """
             )
-            conn.commit()
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS file_chunks (
+                    file_hash BLOB,
+                    seq INTEGER,
+                    chunk_hash BLOB,
+                    PRIMARY KEY(file_hash, seq)
+                )
+            """
+            )
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_file_chunks_chunk ON file_chunks(chunk_hash)")
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_files_snapshot ON files(snapshot_id)")
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_files_hash ON files(hash)")
+            meta = dict(cursor.execute("SELECT key, value FROM meta"))
+            if not existing:
+                meta = {
+                    "hash_algorithm": "blake3" if blake3 is not None else "sha256",
+                    "compression": "zstd" if zstandard is not None else "none",
+                }
+            else:
+                # Existing databases keep the formats their objects were written with.
+                version = int(meta.get("schema_version", 1))
+                if version < 2:
+                    # Databases from before the meta table hold hex SHA-256 keys and may still have inline content.
+                    self._migrate_hex_hashes(cursor)
+                    meta["hash_algorithm"] = "sha256"
+                if version < 3:
+                    meta["compression"] = "none"
+                if version < 4:
+                    cursor.execute("ALTER TABLE snapshots ADD COLUMN total_size INTEGER NOT NULL DEFAULT 0")
+                    cursor.execute(
+                        "UPDATE snapshots SET total_size = "
+                        "(SELECT COALESCE(SUM(size), 0) FROM files WHERE snapshot_id = snapshots.id)"
+                    )
+                if version < 5:
+                    # Each whole-file object becomes the single chunk of its content; object names are unchanged.
+                    cursor.execute("INSERT OR IGNORE INTO chunk_data (hash, size) SELECT hash, size FROM file_data")
+                    cursor.execute(
+                        "INSERT OR IGNORE INTO file_chunks (file_hash, seq, chunk_hash) SELECT hash, 0, hash FROM file_data"
+                    )
+            meta["schema_version"] = str(SCHEMA_VERSION)
+            cursor.executemany("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", meta.items())
+            self.hash_algorithm = meta["hash_algorithm"]
+            self.compression = meta["compression"]
+            self._migrate_inline_content(cursor)
+        if self.hash_algorithm == "blake3" and blake3 is None:
+            raise RuntimeError(f"{self.db_path} uses BLAKE3 hashes; install the 'blake3' package to open it")
+        if self.compression == "zstd" and zstandard is None:
+            raise RuntimeError(f"{self.db_path} stores zstd-compressed objects; install the 'zstandard' package to open it")
+
+    def _migrate_hex_hashes(self, cursor):
+        """Convert hex-encoded hash keys written by older versions to raw digest bytes."""
+        cursor.connection.create_function(
+            "unhex_hash", 1, lambda value: bytes.fromhex(value) if isinstance(value, str) else value, deterministic=True
+        )
+        cursor.execute("UPDATE file_data SET hash = unhex_hash(hash)")
+        cursor.execute("UPDATE files SET hash = unhex_hash(hash)")
+
+    def _migrate_inline_content(self, cursor):
+        """Move content stored by older versions in file_data.content into the object store."""
+        columns = [row[1] for row in cursor.execute("PRAGMA table_info(file_data)")]
+        if "content" not in columns:
+            return
+        for file_hash, content in cursor.connection.execute("SELECT hash, content FROM file_data"):
+            if content is not None:
+                self._write_object(file_hash, self._encode_object(content))
+        self._sync_objects()
+        cursor.execute("ALTER TABLE file_data DROP COLUMN content")
+
+    def _object_path(self, file_hash):
+        hex_hash = file_hash.hex()
+        # Compressed objects get their own name so they are never mistaken for raw content.
+        suffix = ".zst" if self.compression == "zstd" else ""
+        return os.path.join(self.object_dir, hex_hash[:2], hex_hash[2:] + suffix)
+
+    def _compressor(self):
+        """Return this thread's zstd compressor; compressor objects must not be shared between threads."""
+        compressor = getattr(self._local, "compressor", None)
+        if compressor is None:
+            compressor = self._local.compressor = zstandard.ZstdCompressor(level=ZSTD_LEVEL)
+        return compressor
+
+    def _encode_object(self, data):
+        return self._compressor().compress(data) if self.compression == "zstd" else data
+
+    @contextmanager
+    def _open_object(self, file_hash):
+        """Open the object for `file_hash` as a readable stream of its original bytes."""
+        with open(self._object_path(file_hash), 'rb') as f:
+            if self.compression == "zstd":
+                with zstandard.ZstdDecompressor().stream_reader(f) as reader:
+                    yield reader
+            else:
+                yield f
 
-    def _hash_file(self, file_path):
-        hasher = hashlib.sha256()
-        size = os.path.getsize(file_path)
-        with open(file_path, 'rb') as f:
-            while chunk := f.read(8192):
-                hasher.update(chunk)
-        return hasher.hexdigest(), size
+    def _restore_file(self, chunk_hashes, target_path):
+        """Write `target_path` by concatenating the given chunk objects in order."""
+        # An earlier restore may have hard-linked this path to another file; truncating it in
+        # place would overwrite that file too, so the old link is removed first.
+        if os.path.lexists(target_path):
+            os.unlink(target_path)
+        with open(target_path, 'xb', buffering=0) as dst:
+            for chunk_hash in chunk_hashes:
+                with open(self._object_path(chunk_hash), 'rb', buffering=0) as src:
+                    if self.compression == "zstd":
+                        zstandard.ZstdDecompressor().copy_stream(src, dst)
+                    else:
+                        self._copy_stream(src, dst)
+
+    def _link_file(self, src_path, dst_path):
+        """Hard-link dst_path to src_path, replacing any existing file; return False if links are unsupported."""
+        try:
+            if os.path.lexists(dst_path):
+                os.unlink(dst_path)
+            os.link(src_path, dst_path)
+        except OSError:
+            return False
+        return True
+
+    def _copy_stream(self, src, dst):
+        """Append the rest of `src` to `dst` inside the kernel with copy_file_range where supported."""
+        if hasattr(os, "copy_file_range"):
+            remaining = os.fstat(src.fileno()).st_size - src.tell()
+            try:
+                while remaining > 0:
+                    copied = os.copy_file_range(src.fileno(), dst.fileno(), remaining)
+                    if not copied:
+                        # Some FUSE and pseudo filesystems copy nothing instead of failing.
+                        break
+                    remaining -= copied
+                else:
+                    return
+            except OSError as e:
+                # Old kernels, cross-filesystem copies and some filesystems reject the syscall.
+                if e.errno not in (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP):
+                    raise
+        # File offsets have advanced past anything already copied, so userspace copying resumes there.
+        shutil.copyfileobj(src, dst, READ_BUFFER_SIZE)
+
+    def _new_hasher(self, data=b""):
+        """Return a hasher for this database's content hash algorithm."""
+        if self.hash_algorithm == "blake3":
+            return blake3.blake3(data)
+        return hashlib.sha256(data)
+
+    def _write_object(self, object_hash, data):
+        """Create the object for `object_hash` from already encoded `data` unless present.
+
+        Nothing is fsynced here; the object only becomes durable once _sync_objects runs before
+        the rows referencing it commit.
+        """
+        object_path = self._object_path(object_hash)
+        if os.path.exists(object_path):
+            return
+        shard_dir = os.path.dirname(object_path)
+        os.makedirs(shard_dir, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=shard_dir, prefix=".tmp-")
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, object_path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+        with self._unsynced_lock:
+            self._unsynced_objects += 1
+
+    def _sync_objects(self):
+        """Flush every object written since the last call, and the renames that placed them, to disk.
+
+        A single sync(2) per batch is far cheaper than an fsync per object and per directory.
+        """
+        with self._unsynced_lock:
+            pending, self._unsynced_objects = self._unsynced_objects, 0
+        if pending:
+            os.sync()
+
+    def _read_buffer(self, size):
+        """Return this thread's reusable read buffer, growing it to at least `size` bytes."""
+        buffer = getattr(self._local, "buffer", None)
+        if buffer is None or len(buffer) < size:
+            buffer = self._local.buffer = bytearray(size)
+        return buffer
+
+    def _hash_stream(self, stream, block_size=READ_BUFFER_SIZE):
+        """Return (hash, size) of everything read from `stream`."""
+        hasher = self._new_hasher()
+        buffer = self._read_buffer(block_size)
+        view = memoryview(buffer)
+        size = 0
+        while n := stream.readinto(buffer):
+            hasher.update(view[:n])
+            size += n
+        return hasher.digest(), size
+
+    @contextmanager
+    def _read_file(self, file_path):
+        """Yield a file's content as bytes, or as a read-only mmap for large files.
+
+        A mapped file that another process truncates while it is being read raises SIGBUS on
+        access to the vanished pages, which kills the process; snapshot sources are expected to
+        be quiescent, as they must be for the snapshot to be consistent anyway.
+        """
+        with open(file_path, 'rb', buffering=0) as f:
+            size = os.fstat(f.fileno()).st_size
+            if size < MMAP_THRESHOLD:
+                yield f.readall()
+                return
+            # Large files are read straight from the page cache and hashed in a single update call.
+            with mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ) as mm:
+                if hasattr(mm, "madvise"):
+                    mm.madvise(mmap.MADV_SEQUENTIAL)
+                yield mm
+
+    def _chunk_boundaries(self, data):
+        """Return (offset, length) of each chunk of `data`, content-defined when fastcdc is available."""
+        if fastcdc is not None:
+            return [(chunk.offset, chunk.length) for chunk in fastcdc(data, CHUNK_MIN_SIZE, CHUNK_AVG_SIZE, CHUNK_MAX_SIZE)]
+        return [(offset, min(CHUNK_AVG_SIZE, len(data) - offset)) for offset in range(0, len(data), CHUNK_AVG_SIZE)]
+
+    def _store_file(self, file_path, known_hashes=frozenset(), known_chunks=frozenset()):
+        """Hash a file and store whichever of its chunks are new, reading it only once.
+
+        Returns (hash, size, chunks) where chunks lists (chunk_hash, chunk_size) in file order, or is
+        None when `known_hashes` shows the whole content is already stored.
+        """
+        with self._read_file(file_path) as data:
+            file_hash = self._new_hasher(data).digest()
+            if file_hash in known_hashes:
+                return file_hash, len(data), None
+            chunks = []
+            for offset, length in self._chunk_boundaries(data):
+                chunk = data[offset:offset + length]
+                # A file below the minimum chunk size is one chunk equal to the whole file.
+                chunk_hash = file_hash if length == len(data) else self._new_hasher(chunk).digest()
+                if chunk_hash not in known_chunks:
+                    self._write_object(chunk_hash, self._encode_object(chunk))
+                chunks.append((chunk_hash, length))
+            return file_hash, len(data), chunks
+
+    def _store_files_native(self, paths, known_hashes, known_chunks, executor):
+        """Pre-filter `paths` with the bkhash extension, then chunk and store only content not yet known.
+
+        Hashing runs entirely in native threads, so unchanged files never reach Python. Files with new
+        content are read and hashed again by _store_file and that result is recorded, so a file changed
+        between the two reads is stored as it was read rather than under the stale native hash.
+        """
+        hashes = [(bytes(file_hash), size) for file_hash, size in bkhash.hash_paths(paths)]
+        new_paths = [path for path, (file_hash, _) in zip(paths, hashes) if file_hash not in known_hashes]
+        stored = dict(zip(new_paths, executor.map(
+            functools.partial(self._store_file, known_hashes=known_hashes, known_chunks=known_chunks), new_paths
+        )))
+        return [stored.get(path, (file_hash, size, None)) for path, (file_hash, size) in zip(paths, hashes)]
+
+    def _verify_object(self, file_hash, size):
+        """Return True if the stored object for `file_hash` exists and its original bytes still match hash and size."""
+        errors = (FileNotFoundError, zstandard.ZstdError) if zstandard is not None else FileNotFoundError
+        try:
+            with self._open_object(file_hash) as f:
+                return self._hash_stream(f) == (file_hash, size)
+        except errors:
+            return False
+
+    def _flush_batch(self, cursor, files_rows, data_rows, chunk_rows, new_chunks):
+        """Write a batch of collected file rows along with the content and chunk rows they introduce."""
+        # Chunks are already in the object store; the dicts only hold hashes new to this database.
+        cursor.executemany("INSERT OR IGNORE INTO chunk_data (hash, size) VALUES (?, ?)", new_chunks.items())
+        cursor.executemany("INSERT OR IGNORE INTO file_chunks (file_hash, seq, chunk_hash) VALUES (?, ?, ?)", chunk_rows)
+        cursor.executemany("INSERT OR IGNORE INTO file_data (hash, size) VALUES (?, ?)", data_rows.items())
+        cursor.executemany("INSERT INTO files (snapshot_id, path, hash, size) VALUES (?, ?, ?, ?)", files_rows)
+        for rows in (files_rows, data_rows, chunk_rows, new_chunks):
+            rows.clear()
+
+    def _walk_files(self, directory):
+        """Yield paths of all files under `directory`, using the dirent type cached by scandir."""
+        try:
+            entries = os.scandir(directory)
+        except PermissionError:
+            # Unreadable directories are skipped rather than aborting the snapshot, as rglob did.
+            return
+        with entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    yield from self._walk_files(entry.path)
+                elif entry.is_file():
+                    yield entry.path
 
     def snapshot(self, target_directory):
         target_directory = Path(target_directory).resolve()
-        with self._connect() as conn:
-            cursor = conn.cursor()
+        with self._tx() as cursor:
             cursor.execute("INSERT INTO snapshots (timestamp) VALUES (?)", (time.strftime("%Y-%m-%d %H:%M:%S"),))
             snapshot_id = cursor.lastrowid
             total_size = 0
+            files_rows = []
+            data_rows = {}
+            chunk_rows = []
+            new_chunks = {}
+            paths = self._walk_files(target_directory)
+            # Dedup against in-memory sets instead of probing file_data and chunk_data for every file.
+            known_hashes = {file_hash for (file_hash,) in cursor.execute("SELECT hash FROM file_data")}
+            known_chunks = {chunk_hash for (chunk_hash,) in cursor.execute("SELECT hash FROM chunk_data")}
+            store_file = functools.partial(self._store_file, known_hashes=known_hashes, known_chunks=known_chunks)
             
-            for file in target_directory.rglob("*"):
-                if file.is_file():
-                    file_hash, file_size = self._hash_file(file)
-                    total_size += file_size
-                    cursor.execute("INSERT INTO files (snapshot_id, path, hash, size) VALUES (?, ?, ?, ?)",
-                                   (snapshot_id, str(file.relative_to(target_directory)), file_hash, file_size))
-                    
-                    cursor.execute("SELECT hash FROM file_data WHERE hash = ?", (file_hash,))
-                    if not cursor.fetchone():
-                        with open(file, 'rb') as f:
-                            cursor.execute("INSERT INTO file_data (hash, content, size) VALUES (?, ?, ?)",
-                                           (file_hash, f.read(), file_size))
+            # Hashing and object writes run on worker threads (hashlib releases the GIL); all
+            # database writes stay on this thread. Paths are fed one batch at a time to bound memory.
+            with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+                while batch := list(itertools.islice(paths, BATCH_SIZE)):
+                    # The native pass only pays off when it can rule files out: with nothing stored
+                    # yet every file would be read again by _store_file anyway.
+                    if bkhash is not None and self.hash_algorithm == "blake3" and known_hashes:
+                        results = self._store_files_native(batch, known_hashes, known_chunks, executor)
+                    else:
+                        results = executor.map(store_file, batch)
+                    for file, (file_hash, file_size, chunks) in zip(batch, results):
+                        total_size += file_size
+                        files_rows.append((snapshot_id, os.path.relpath(file, target_directory), file_hash, file_size))
+                        if file_hash in known_hashes:
+                            continue
+                        known_hashes.add(file_hash)
+                        data_rows[file_hash] = file_size
+                        for seq, (chunk_hash, chunk_size) in enumerate(chunks):
+                            chunk_rows.append((file_hash, seq, chunk_hash))
+                            if chunk_hash not in known_chunks:
+                                known_chunks.add(chunk_hash)
+                                new_chunks[chunk_hash] = chunk_size
+                    # Objects must be durable before the rows that reference them are committed.
+                    self._sync_objects()
+                    self._flush_batch(cursor, files_rows, data_rows, chunk_rows, new_chunks)
             
-            conn.commit()
+            cursor.execute("UPDATE snapshots SET total_size = ? WHERE id = ?", (total_size, snapshot_id))
         print(f"Snapshot {snapshot_id} created. Total size: {total_size} bytes")
         return snapshot_id
     
     def list_snapshots(self):
-        with self._connect() as conn:
-            cursor = conn.cursor()
-            cursor.execute("SELECT s.id, s.timestamp, COALESCE(SUM(f.size), 0) FROM snapshots s LEFT JOIN files f ON s.id = f.snapshot_id GROUP BY s.id")
-            snapshots = cursor.fetchall()
+        with self._tx("DEFERRED") as cursor:
+            # total_size is recorded when the snapshot is taken, so listing never touches files.
+            cursor.arraysize = 1000
+            cursor.execute("SELECT id, timestamp, total_size FROM snapshots ORDER BY id")
             print("SNAPSHOT  TIMESTAMP           SIZE (bytes)")
-            for snap in snapshots:
-                print(f"{snap[0]}        {snap[1]}    {snap[2]}")
+            while snapshots := cursor.fetchmany():
+                for snap in snapshots:
+                    print(f"{snap[0]}        {snap[1]}    {snap[2]}")
     
     def restore(self, snapshot_number, output_directory):
         output_directory = Path(output_directory).resolve()
         os.makedirs(output_directory, exist_ok=True)
-        with self._connect() as conn:
-            cursor = conn.cursor()
-            cursor.execute("SELECT path, hash FROM files WHERE snapshot_id = ?", (snapshot_number,))
-            files = cursor.fetchall()
+        with self._tx("DEFERRED") as cursor:
+            # LEFT JOIN keeps empty files, which have no chunks.
+            cursor.execute(
+                "SELECT f.path, f.hash, c.chunk_hash FROM files f "
+                "LEFT JOIN file_chunks c ON c.file_hash = f.hash "
+                "WHERE f.snapshot_id = ? ORDER BY f.rowid, c.seq",
+                (snapshot_number,),
+            )
             
-            for rel_path, file_hash in files:
+            materialised = {}
+            for (rel_path, file_hash), rows in itertools.groupby(cursor, key=lambda row: row[:2]):
                 target_path = output_directory / rel_path
                 os.makedirs(target_path.parent, exist_ok=True)
-                cursor.execute("SELECT content FROM file_data WHERE hash = ?", (file_hash,))
-                content = cursor.fetchone()
-                if content:
-                    with open(target_path, 'wb') as f:
-                        f.write(content[0])
+                # Later paths with the same content are hard-linked to the first restored copy.
+                if file_hash in materialised and self._link_file(materialised[file_hash], target_path):
+                    continue
+                self._restore_file([chunk_hash for _, _, chunk_hash in rows if chunk_hash is not None], target_path)
+                materialised[file_hash] = target_path
         print(f"Snapshot {snapshot_number} restored to {output_directory}.")
     
     def prune(self, snapshot_number):
-        with self._connect() as conn:
-            cursor = conn.cursor()
-            cursor.execute("PRAGMA foreign_keys = ON;")
+        with self._tx() as cursor:
+            # files rows go with the snapshot through ON DELETE CASCADE.
             cursor.execute("DELETE FROM snapshots WHERE id = ?", (snapshot_number,))
-            cursor.execute("DELETE FROM files WHERE snapshot_id = ?", (snapshot_number,))
-            conn.commit()
-        print(f"Snapshot {snapshot_number} pruned.")
+            # Garbage-collect content no remaining snapshot references, then chunks no remaining
+            # content uses.
+            cursor.execute(
+                "DELETE FROM file_chunks WHERE file_hash IN "
+                "(SELECT hash FROM file_data WHERE hash NOT IN (SELECT hash FROM files))"
+            )
+            cursor.execute("DELETE FROM file_data WHERE hash NOT IN (SELECT hash FROM files)")
+            cursor.execute("DELETE FROM chunk_data WHERE hash NOT IN (SELECT chunk_hash FROM file_chunks)")
+        # Objects are unlinked only once the deletions have committed, so a crash can leave stray
+        # objects but never rows pointing at missing ones. The write lock keeps snapshots out while
+        # the store is swept.
+        with self._tx() as cursor:
+            removed = self._sweep_objects(cursor)
+        self.conn.execute("PRAGMA incremental_vacuum;").fetchall()  # the pragma frees pages as it is stepped
+        print(f"Snapshot {snapshot_number} pruned. Removed {removed} unreferenced objects.")
+
+    def _sweep_objects(self, cursor):
+        """Unlink every object without a chunk_data row and any leftover temp file; return the object count.
+
+        Besides chunks just pruned, this reclaims objects written by snapshots that rolled back and
+        temp files of interrupted writes, none of which ever had a row.
+        """
+        suffix = ".zst" if self.compression == "zstd" else ""
+        stored = {chunk_hash.hex() + suffix for (chunk_hash,) in cursor.execute("SELECT hash FROM chunk_data")}
+        removed = 0
+        with os.scandir(self.object_dir) as shards:
+            for shard in shards:
+                if not shard.is_dir(follow_symlinks=False):
+                    continue
+                with os.scandir(shard.path) as entries:
+                    for entry in entries:
+                        if shard.name + entry.name in stored:
+                            continue
+                        os.unlink(entry.path)
+                        removed += not entry.name.startswith(".tmp-")
+        return removed
     
+    def _verify_range(self, bounds):
+        """Verify chunk_data rows with rowid in the inclusive `bounds`; return the first corrupt hash or None."""
+        # Runs in pool workers, so it opens its own read-only connection.
+        conn = sqlite3.connect(Path(self.db_path).resolve().as_uri() + "?mode=ro", uri=True)
+        try:
+            conn.execute("PRAGMA query_only = 1;")
+            # Rows are streamed from the cursor and each object is hashed through the
+            # reusable read buffer, so memory stays bounded regardless of store size.
+            for chunk_hash, size in conn.execute("SELECT hash, size FROM chunk_data WHERE rowid BETWEEN ? AND ?", bounds):
+                if not self._verify_object(chunk_hash, size):
+                    return chunk_hash
+        finally:
+            conn.close()
+        return None
+
     def check(self):
-        with self._connect() as conn:
-            cursor = conn.cursor()
-            cursor.execute("SELECT hash, content FROM file_data")
-            files = cursor.fetchall()
-            for file_hash, content in files:
-                if hashlib.sha256(content).hexdigest() != file_hash:
-                    print(f"Corruption detected for hash: {file_hash}")
-                    return
+        with self._tx("DEFERRED") as cursor:
+            low, high, count = cursor.execute("SELECT MIN(rowid), MAX(rowid), COUNT(*) FROM chunk_data").fetchone()
+            corrupt_hash = None
+            if count and count < CHECK_PARALLEL_THRESHOLD:
+                corrupt_hash = self._verify_range((low, high))
+            elif count:
+                # Objects are independent, so contiguous rowid shards are verified across processes.
+                processes = os.cpu_count() or 1
+                step = -(-(high - low + 1) // (processes * 4))
+                shards = [(start, min(start + step - 1, high)) for start in range(low, high + 1, step)]
+                with multiprocessing.Pool(processes) as pool:
+                    corrupt_hash = next(filter(None, pool.imap_unordered(self._verify_range, shards)), None)
+        if corrupt_hash:
+            print(f"Corruption detected for hash: {corrupt_hash.hex()}")
+            return
         print("All files verified successfully.")
 
 if __name__ == "__main__":
@@ -166,3 +614,4 @@ if __name__ == "__main__":
         tool.check()
     else:
         parser.print_help()
+    tool.close()
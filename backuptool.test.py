@@ -1,26 +1,36 @@
+import contextlib
+import io
 import os
 import sqlite3
 import hashlib
 import shutil
 import json
+import tempfile
 import time
 import unittest
+from unittest import mock
 from pathlib import Path
+import backuptool
 from backuptool import BackupTool
 
 class TestBackupTool(unittest.TestCase):
     TEST_DIR = "./test_data"
     RESTORE_DIR = "./restore_data"
-    TEST_DB = "test_backup.db"
     
     @classmethod
     def setUpClass(cls):
         os.makedirs(cls.TEST_DIR, exist_ok=True)
+        # Databases and their object stores live in a scratch directory, so every run starts
+        # from a fresh database in the default format.
+        cls.DB_DIR = tempfile.mkdtemp()
+        cls.TEST_DB = os.path.join(cls.DB_DIR, "test_backup.db")
         cls.tool = BackupTool(db_path=cls.TEST_DB)
     
     @classmethod
     def tearDownClass(cls):
+        cls.tool.close()
         del cls.tool        
+        shutil.rmtree(cls.DB_DIR, ignore_errors=True)
         shutil.rmtree(cls.TEST_DIR, ignore_errors=True)
         shutil.rmtree(cls.RESTORE_DIR, ignore_errors=True)
 
@@ -61,6 +71,86 @@ class TestBackupTool(unittest.TestCase):
         
         self.assertEqual(snapshot_count, 0, "Snapshot should be removed")
     
+    def test_prune_removes_unreferenced_content_only(self):
+        source_dir = Path(self.TEST_DIR) / "prune_source"
+        os.makedirs(source_dir, exist_ok=True)
+        shared = source_dir / "shared.bin"
+        unique = source_dir / "unique.bin"
+        shared.write_bytes(os.urandom(512))
+        unique.write_bytes(os.urandom(512))
+        pruned_id = self.tool.snapshot(source_dir)
+        unique_object = Path(self.tool._object_path(self.tool._new_hasher(unique.read_bytes()).digest()))
+        unique.unlink()
+        kept_id = self.tool.snapshot(source_dir)
+
+        self.tool.prune(pruned_id)
+
+        self.assertFalse(unique_object.exists(), "Content only referenced by the pruned snapshot should be removed")
+        self.tool.restore(kept_id, self.RESTORE_DIR)
+        self.assertEqual((Path(self.RESTORE_DIR) / "shared.bin").read_bytes(), shared.read_bytes())
+        shutil.rmtree(source_dir)
+
+    def test_prune_sweeps_objects_without_rows(self):
+        sweep_db = os.path.join(self.DB_DIR, "sweep_test_backup.db")
+        source_dir = Path(self.TEST_DIR) / "sweep_source"
+        os.makedirs(source_dir, exist_ok=True)
+        (source_dir / "kept.bin").write_bytes(os.urandom(512))
+        tool = BackupTool(db_path=sweep_db)
+        try:
+            kept_id = tool.snapshot(source_dir)
+            # A snapshot that rolls back leaves its objects behind without rows, and an
+            # interrupted write leaves its temp file.
+            leaked = os.urandom(512)
+            leaked_hash = tool._new_hasher(leaked).digest()
+            tool._write_object(leaked_hash, tool._encode_object(leaked))
+            leaked_object = Path(tool._object_path(leaked_hash))
+            stray_temp = leaked_object.parent / ".tmp-interrupted"
+            stray_temp.write_bytes(b"partial")
+            (source_dir / "pruned.bin").write_bytes(os.urandom(512))
+            pruned_id = tool.snapshot(source_dir)
+
+            output = io.StringIO()
+            with contextlib.redirect_stdout(output):
+                tool.prune(pruned_id)
+            self.assertIn("Removed 2 unreferenced objects", output.getvalue())
+            self.assertFalse(leaked_object.exists())
+            self.assertFalse(stray_temp.exists())
+            tool.restore(kept_id, self.RESTORE_DIR)
+            self.assertEqual((Path(self.RESTORE_DIR) / "kept.bin").read_bytes(), (source_dir / "kept.bin").read_bytes())
+        finally:
+            tool.close()
+            shutil.rmtree(source_dir)
+
+    def test_prune_leaves_other_databases_intact(self):
+        other_db = os.path.join(self.DB_DIR, "other_test_backup.db")
+        source_dir = Path(self.TEST_DIR) / "shared_source"
+        os.makedirs(source_dir, exist_ok=True)
+        (source_dir / "common.bin").write_bytes(os.urandom(512))
+        kept_id = self.tool.snapshot(source_dir)
+        other = BackupTool(db_path=other_db)
+        try:
+            other.prune(other.snapshot(source_dir))
+        finally:
+            other.close()
+
+        self.tool.restore(kept_id, self.RESTORE_DIR)
+        self.assertEqual((Path(self.RESTORE_DIR) / "common.bin").read_bytes(), (source_dir / "common.bin").read_bytes())
+        shutil.rmtree(source_dir)
+
+    def test_list_reports_snapshot_size(self):
+        source_dir = Path(self.TEST_DIR) / "list_source"
+        os.makedirs(source_dir, exist_ok=True)
+        (source_dir / "a.txt").write_text("12345")
+        (source_dir / "b.txt").write_text("678")
+        snapshot_id = self.tool.snapshot(source_dir)
+
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            self.tool.list_snapshots()
+        row = next(line.split() for line in output.getvalue().splitlines() if line.split()[0] == str(snapshot_id))
+        self.assertEqual(row[-1], "8")
+        shutil.rmtree(source_dir)
+
     def test_binary_file_handling(self):
         file_path = Path(self.TEST_DIR) / "image.bin"
         with open(file_path, "wb") as f:
@@ -76,9 +166,234 @@ class TestBackupTool(unittest.TestCase):
         restored = restored_path.read_bytes()
         self.assertEqual(original, restored, "Binary files should be restored identically")
         
+    def test_duplicate_files_are_restored(self):
+        (Path(self.TEST_DIR) / "copy1.txt").write_text("Repeated asset")
+        os.makedirs(Path(self.TEST_DIR) / "nested", exist_ok=True)
+        (Path(self.TEST_DIR) / "nested" / "copy2.txt").write_text("Repeated asset")
+
+        snapshot_id = self.tool.snapshot(self.TEST_DIR)
+        self.tool.restore(snapshot_id, self.RESTORE_DIR)
+
+        first = Path(self.RESTORE_DIR) / "copy1.txt"
+        second = Path(self.RESTORE_DIR) / "nested" / "copy2.txt"
+        self.assertEqual(first.read_text(), "Repeated asset")
+        self.assertEqual(second.read_text(), "Repeated asset")
+        self.assertTrue(os.path.samefile(first, second), "Duplicate content should be hard-linked on restore")
+
+        source_dir = Path(self.TEST_DIR) / "relink_source"
+        os.makedirs(source_dir, exist_ok=True)
+        (source_dir / "x.txt").write_text("same")
+        (source_dir / "y.txt").write_text("same")
+        linked_id = self.tool.snapshot(source_dir)
+        (source_dir / "x.txt").write_text("X-new")
+        (source_dir / "y.txt").write_text("Y-new")
+        edited_id = self.tool.snapshot(source_dir)
+        out_dir = Path(self.RESTORE_DIR) / "relink"
+        self.tool.restore(linked_id, out_dir)
+        self.tool.restore(edited_id, out_dir)
+        self.assertEqual((out_dir / "x.txt").read_text(), "X-new")
+        self.assertEqual((out_dir / "y.txt").read_text(), "Y-new")
+        shutil.rmtree(source_dir)
+
+    def test_unreadable_directory_is_skipped(self):
+        source_dir = Path(self.TEST_DIR) / "locked_source"
+        os.makedirs(source_dir / "locked", exist_ok=True)
+        (source_dir / "open.txt").write_text("readable")
+        (source_dir / "locked" / "hidden.txt").write_text("unreadable")
+        scandir = os.scandir
+
+        def deny_locked(path):
+            if os.path.basename(path) == "locked":
+                raise PermissionError(13, "Permission denied", path)
+            return scandir(path)
+
+        with mock.patch("os.scandir", deny_locked):
+            snapshot_id = self.tool.snapshot(source_dir)
+        self.tool.restore(snapshot_id, self.RESTORE_DIR)
+        self.assertEqual((Path(self.RESTORE_DIR) / "open.txt").read_text(), "readable")
+        self.assertFalse((Path(self.RESTORE_DIR) / "locked" / "hidden.txt").exists())
+        shutil.rmtree(source_dir)
+
+    def test_unchanged_snapshot_stores_no_new_content(self):
+        (Path(self.TEST_DIR) / "dup1.txt").write_text("Same content")
+        (Path(self.TEST_DIR) / "dup2.txt").write_text("Same content")
+        self.tool.snapshot(self.TEST_DIR)
+
+        with sqlite3.connect(self.TEST_DB) as conn:
+            before = conn.execute("SELECT COUNT(*) FROM file_data").fetchone()[0]
+        self.tool.snapshot(self.TEST_DIR)
+        with sqlite3.connect(self.TEST_DB) as conn:
+            after = conn.execute("SELECT COUNT(*) FROM file_data").fetchone()[0]
+
+        self.assertEqual(before, after, "Unchanged snapshot should not store duplicate content")
+
+    def test_edited_large_file_stores_only_new_chunks(self):
+        source_dir = Path(self.TEST_DIR) / "chunk_source"
+        os.makedirs(source_dir, exist_ok=True)
+        large = source_dir / "large.bin"
+        # Large enough to be read through mmap.
+        original = os.urandom(backuptool.MMAP_THRESHOLD + 12345)
+        large.write_bytes(original)
+        self.tool.snapshot(source_dir)
+        with sqlite3.connect(self.TEST_DB) as conn:
+            before = conn.execute("SELECT COUNT(*) FROM chunk_data").fetchone()[0]
+
+        large.write_bytes(original + b"appended edit")
+        snapshot_id = self.tool.snapshot(source_dir)
+        with sqlite3.connect(self.TEST_DB) as conn:
+            after = conn.execute("SELECT COUNT(*) FROM chunk_data").fetchone()[0]
+
+        self.assertLessEqual(after - before, 2, "Only chunks around the edit should be stored again")
+        self.tool.restore(snapshot_id, self.RESTORE_DIR)
+        self.assertEqual((Path(self.RESTORE_DIR) / "large.bin").read_bytes(), original + b"appended edit")
+        shutil.rmtree(source_dir)
+
+    @unittest.skipUnless(backuptool.zstandard is not None, "zstandard not installed")
+    def test_compressed_multi_chunk_file_is_restored(self):
+        zstd_db = os.path.join(self.DB_DIR, "zstd_test_backup.db")
+        source_dir = Path(self.TEST_DIR) / "zstd_source"
+        os.makedirs(source_dir, exist_ok=True)
+        content = os.urandom(2 * backuptool.CHUNK_MAX_SIZE + 1)
+        (source_dir / "big.bin").write_bytes(content)
+        tool = BackupTool(db_path=zstd_db)
+        try:
+            self.assertEqual(tool.compression, "zstd")
+            snapshot_id = tool.snapshot(source_dir)
+            chunk_hashes = [row[0] for row in tool.conn.execute("SELECT chunk_hash FROM file_chunks")]
+            self.assertGreater(len(chunk_hashes), 1)
+            for chunk_hash in chunk_hashes:
+                self.assertTrue(tool._object_path(chunk_hash).endswith(".zst"))
+                self.assertTrue(os.path.exists(tool._object_path(chunk_hash)))
+            tool.restore(snapshot_id, self.RESTORE_DIR)
+            self.assertEqual((Path(self.RESTORE_DIR) / "big.bin").read_bytes(), content)
+        finally:
+            tool.close()
+            shutil.rmtree(source_dir)
+
+    @unittest.skipUnless(hasattr(os, "copy_file_range"), "copy_file_range not available")
+    def test_copy_stream_falls_back_when_kernel_copies_nothing(self):
+        content = os.urandom(4096)
+        src_path = Path(self.DB_DIR) / "copy_src.bin"
+        dst_path = Path(self.DB_DIR) / "copy_dst.bin"
+        src_path.write_bytes(content)
+        with open(src_path, 'rb', buffering=0) as src, open(dst_path, 'wb', buffering=0) as dst:
+            with mock.patch("os.copy_file_range", return_value=0):
+                self.tool._copy_stream(src, dst)
+        self.assertEqual(dst_path.read_bytes(), content)
+
+    def test_legacy_inline_content_is_migrated(self):
+        legacy_db = os.path.join(self.DB_DIR, "legacy_test_backup.db")
+        content = b"Stored inline by an older version"
+        file_hash = hashlib.sha256(content).hexdigest()
+        conn = sqlite3.connect(legacy_db)
+        conn.execute("CREATE TABLE snapshots (id INTEGER PRIMARY KEY AUTOINCREMENT, timestamp TEXT NOT NULL)")
+        conn.execute("CREATE TABLE files (snapshot_id INTEGER, path TEXT, hash TEXT, size INTEGER)")
+        conn.execute("CREATE TABLE file_data (hash TEXT PRIMARY KEY, content BLOB, size INTEGER)")
+        conn.execute("INSERT INTO snapshots (id, timestamp) VALUES (1, '2025-01-01 00:00:00')")
+        conn.execute("INSERT INTO files VALUES (1, 'legacy.txt', ?, ?)", (file_hash, len(content)))
+        conn.execute("INSERT INTO file_data VALUES (?, ?, ?)", (file_hash, content, len(content)))
+        conn.commit()
+        conn.close()
+        tool = BackupTool(db_path=legacy_db)
+        try:
+            tool.restore(1, self.RESTORE_DIR)
+            self.assertEqual((Path(self.RESTORE_DIR) / "legacy.txt").read_bytes(), content)
+        finally:
+            tool.close()
+
+    def test_object_store_follows_database_location(self):
+        file_path = Path(self.TEST_DIR) / "located.txt"
+        file_path.write_text("Found from anywhere")
+        snapshot_id = self.tool.snapshot(self.TEST_DIR)
+
+        cwd = os.getcwd()
+        os.chdir(self.RESTORE_DIR)
+        try:
+            self.tool.restore(snapshot_id, ".")
+        finally:
+            os.chdir(cwd)
+        self.assertEqual((Path(self.RESTORE_DIR) / "located.txt").read_text(), "Found from anywhere")
+        self.assertEqual(Path(self.tool.object_dir).parents[1], Path(self.TEST_DB).resolve().parent / backuptool.SNAPSHOT_DIR)
+
+    @unittest.skipUnless(backuptool.bkhash is not None, "bkhash extension not built")
+    def test_native_hashes_match_python(self):
+        file_path = Path(self.TEST_DIR) / "native.bin"
+        file_path.write_bytes(os.urandom(4096))
+        (native_hash, native_size), = backuptool.bkhash.hash_paths([str(file_path)])
+        self.assertEqual((bytes(native_hash), native_size), (backuptool.blake3.blake3(file_path.read_bytes()).digest(), 4096))
+
+    @unittest.skipUnless(backuptool.blake3 is not None, "blake3 not installed")
+    def test_native_hashes_prefilter_unchanged_files(self):
+        native_db = os.path.join(self.DB_DIR, "prefilter_test_backup.db")
+        source_dir = Path(self.TEST_DIR) / "prefilter_source"
+        os.makedirs(source_dir, exist_ok=True)
+        (source_dir / "steady.bin").write_bytes(os.urandom(512))
+        # Same contract as the extension's hash_paths, computed in Python.
+        fake = mock.Mock(hash_paths=mock.Mock(side_effect=lambda paths: [
+            (backuptool.blake3.blake3(Path(path).read_bytes()).digest(), os.path.getsize(path)) for path in paths
+        ]))
+        tool = BackupTool(db_path=native_db)
+        try:
+            with mock.patch("backuptool.bkhash", fake):
+                tool.snapshot(source_dir)
+                fake.hash_paths.assert_not_called()  # nothing is known yet, so there is nothing to rule out
+                with mock.patch.object(tool, "_store_file", wraps=tool._store_file) as store_file:
+                    snapshot_id = tool.snapshot(source_dir)
+            fake.hash_paths.assert_called_once()
+            store_file.assert_not_called()
+            tool.restore(snapshot_id, self.RESTORE_DIR)
+            self.assertEqual((Path(self.RESTORE_DIR) / "steady.bin").read_bytes(), (source_dir / "steady.bin").read_bytes())
+        finally:
+            tool.close()
+            shutil.rmtree(source_dir)
+
+    @unittest.skipUnless(backuptool.blake3 is not None, "blake3 not installed")
+    def test_stale_native_hash_is_not_recorded(self):
+        native_db = os.path.join(self.DB_DIR, "native_test_backup.db")
+        source_dir = Path(self.TEST_DIR) / "native_source"
+        os.makedirs(source_dir, exist_ok=True)
+        (source_dir / "seed.bin").write_bytes(b"already stored")
+        tool = BackupTool(db_path=native_db)
+        try:
+            tool.snapshot(source_dir)
+            (source_dir / "changed.bin").write_bytes(b"read later")
+            # The extension reports a hash for content the file no longer holds when it is stored.
+            stale = mock.Mock(hash_paths=lambda paths: [(bytes(32), 3) for _ in paths])
+            with mock.patch("backuptool.bkhash", stale):
+                snapshot_id = tool.snapshot(source_dir)
+            recorded = tool.conn.execute(
+                "SELECT hash, size FROM files WHERE snapshot_id = ? AND path = 'changed.bin'", (snapshot_id,)
+            ).fetchone()
+            self.assertEqual(recorded, (backuptool.blake3.blake3(b"read later").digest(), 10))
+            tool.restore(snapshot_id, self.RESTORE_DIR)
+            self.assertEqual((Path(self.RESTORE_DIR) / "changed.bin").read_bytes(), b"read later")
+        finally:
+            tool.close()
+            shutil.rmtree(source_dir)
+
     def test_check_integrity(self):
         self.tool.snapshot(self.TEST_DIR)
         self.tool.check()
+
+    def test_check_detects_corruption_in_parallel(self):
+        corrupt_db = os.path.join(self.DB_DIR, "corrupt_test_backup.db")
+        source_dir = Path(self.TEST_DIR) / "corrupt_source"
+        os.makedirs(source_dir, exist_ok=True)
+        content = os.urandom(2048)
+        (source_dir / "victim.bin").write_bytes(content)
+        tool = BackupTool(db_path=corrupt_db)
+        object_path = tool._object_path(tool._new_hasher(content).digest())
+        try:
+            tool.snapshot(source_dir)
+            Path(object_path).write_bytes(b"tampered")
+
+            output = io.StringIO()
+            with mock.patch("backuptool.CHECK_PARALLEL_THRESHOLD", 0), contextlib.redirect_stdout(output):
+                tool.check()
+            self.assertIn("Corruption detected", output.getvalue())
+        finally:
+            tool.close()
+            shutil.rmtree(source_dir)
         
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,33 @@
+use std::io;
+use std::path::PathBuf;
+
+use pyo3::prelude::*;
+use pyo3::types::PyBytes;
+use rayon::prelude::*;
+
+/// Hash one file through a memory map, letting blake3 split large files across the rayon pool.
+fn hash_one(path: &PathBuf) -> io::Result<([u8; 32], u64)> {
+    let mut hasher = blake3::Hasher::new();
+    hasher.update_mmap_rayon(path)?;
+    Ok((*hasher.finalize().as_bytes(), hasher.count()))
+}
+
+/// Return a (digest, size) tuple for every path, hashing them in parallel without the GIL.
+#[pyfunction]
+fn hash_paths(py: Python<'_>, paths: Vec<PathBuf>) -> PyResult<Vec<(Py<PyBytes>, u64)>> {
+    let results: Vec<io::Result<([u8; 32], u64)>> =
+        py.allow_threads(|| paths.par_iter().map(hash_one).collect());
+    results
+        .into_iter()
+        .map(|result| {
+            let (digest, size) = result?;
+            Ok((PyBytes::new_bound(py, &digest).unbind(), size))
+        })
+        .collect()
+}
+
+#[pymodule]
+fn bkhash(m: &Bound<'_, PyModule>) -> PyResult<()> {
+    m.add_function(wrap_pyfunction!(hash_paths, m)?)?;
+    Ok(())
+}